@@ -1,10 +1,14 @@
+import functools
 import itertools
+import os
 import sys
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable
 
 from plado.datalog.evaluator.compiler import (
+    EVALUATOR,
     FLUENTS,
     RELATIONS,
+    compile_fluent_lookups,
     compile_interdepending,
     compile_without_dependencies,
 )
@@ -13,10 +17,14 @@ from plado.datalog.evaluator.filtering import (
     insert_filter_predicates,
     insert_projections,
 )
-from plado.datalog.evaluator.join_graph import construct_join_graph
-from plado.datalog.evaluator.planner import GreedyOptimizer
+from plado.datalog.evaluator.join_graph import JoinGraph, construct_join_graph
+from plado.datalog.evaluator.planner import (
+    DpCcpOptimizer,
+    GreedyOptimizer,
+    plan_single_atom,
+)
 from plado.datalog.evaluator.query_tree import GroundAtomRef, GroundAtomsNode, QNode
-from plado.datalog.numeric import NumericConstraint
+from plado.datalog.numeric import NumericConstraint, fluent_iterator
 from plado.datalog.program import Atom, Clause, Constant, DatalogProgram
 from plado.utils import Float, tarjan
 
@@ -24,6 +32,15 @@ Table = set[tuple[int]]
 Database = list[Table]
 FluentsTable = dict[tuple[int], Float]
 FluentsDatabase = list[FluentsTable]
+AtomSignature = tuple[int, tuple[int]]
+
+# maximal number of positive atoms for which the optimal join order is computed
+# (otherwise resorting to greedy optimization)
+MAX_DP_ATOMS = 8
+
+# annotate the generated evaluator code with the clauses and their query trees
+# (for debugging)
+EMIT_COMMENTS = os.environ.get("PLADO_EMIT_COMMENTS", "0") not in ("", "0")
 
 
 def _cost_function(relations, args, join_relation, join_args):
@@ -56,10 +73,16 @@ class NormalizedClause:
         self.obj_eq = tuple(obj_eq)
         self.obj_neq = tuple(obj_neq)
         self.constraints = tuple(constraints)
-        assert all((
-            any(varid in atom.get_variables() for atom in self.positive)
-            for varid in range(self.num_variables)
-        )), "all variables must be positively bounded"
+        self.head_arg_ids: frozenset[int] = frozenset(
+            (arg.id for arg in self.head.arguments)
+        )
+        if __debug__:
+            bound = 0
+            for atom in self.positive:
+                bound |= atom.get_variable_mask()
+            assert bound == (1 << self.num_variables) - 1, (
+                "all variables must be positively bounded"
+            )
 
     def __str__(self):
         body = filter(
@@ -76,21 +99,56 @@ class NormalizedClause:
         return f"{self.head} =: {', '.join(body)}"
 
 
+def _atom_signature(atom: Atom) -> AtomSignature:
+    return (atom.relation_id, tuple((arg.id for arg in atom.arguments)))
+
+
+@functools.lru_cache(maxsize=1024)
+def _build_join_graph(
+    key: tuple[int, tuple[AtomSignature], tuple[AtomSignature]],
+) -> JoinGraph:
+    """
+    Memoized join-graph construction. The key consists of the number of
+    variables and the signatures (see _atom_signature) of the positive and
+    negative atoms.
+    """
+    num_variables, positive, negative = key
+
+    def to_atoms(signatures: tuple[AtomSignature]) -> list[Atom]:
+        return [
+            Atom(relation_id, (Constant(x, True) for x in args))
+            for relation_id, args in signatures
+        ]
+
+    return construct_join_graph(num_variables, to_atoms(positive), to_atoms(negative))
+
+
 def _generate_query_tree(
     clause: NormalizedClause,
     cost_function=_cost_function,
 ) -> QNode:
-    jg = construct_join_graph(clause.num_variables, clause.positive, clause.negative)
-    planner = GreedyOptimizer(cost_function)
-    qnode = insert_filter_predicates(
-        clause.vars_eq, clause.vars_neq, clause.obj_eq, clause.obj_neq, planner(jg)
-    )
+    if len(clause.positive) == 1:
+        qnode = plan_single_atom(clause.positive[0], clause.negative, cost_function)
+    else:
+        # clauses often share the same body shape; the cached graph must not be
+        # modified, hence copy it
+        jg = _build_join_graph((
+            clause.num_variables,
+            tuple((_atom_signature(atom) for atom in clause.positive)),
+            tuple((_atom_signature(atom) for atom in clause.negative)),
+        )).copy()
+        if len(clause.positive) <= MAX_DP_ATOMS:
+            planner = DpCcpOptimizer(cost_function)
+        else:
+            planner = GreedyOptimizer(cost_function)
+        qnode = planner(jg)
+    if clause.vars_eq or clause.vars_neq or clause.obj_eq or clause.obj_neq:
+        qnode = insert_filter_predicates(
+            clause.vars_eq, clause.vars_neq, clause.obj_eq, clause.obj_neq, qnode
+        )
     for constraint in clause.constraints:
         qnode = insert_constraint_predicate(constraint, qnode)
-    qnode = insert_projections(
-        qnode,
-        set((arg.id for arg in clause.head.arguments)),
-    )
+    qnode = insert_projections(qnode, clause.head_arg_ids)
     if len(clause.ground_negative) > 0:
         qnode = GroundAtomsNode(qnode, clause.ground_negative, True)
     if len(clause.ground_positive) > 0:
@@ -100,49 +158,60 @@ def _generate_query_tree(
 
 def _get_dependency_graph(
     num_relations: int, clauses: Iterable[NormalizedClause]
-) -> list[list[int]]:
-    dg = [set() for i in range(num_relations)]
+) -> list[int]:
+    """
+    Returns for every relation the bitmask of the relations it depends on.
+    """
+    dg = [0] * num_relations
     for clause in clauses:
-        head = clause.head.relation_id
+        mask = 0
         for atom in itertools.chain(clause.positive, clause.negative):
-            dg[head].add(atom.relation_id)
+            mask |= 1 << atom.relation_id
+        dg[clause.head.relation_id] |= mask
     return dg
 
 
-def _get_dependent_components(dg: list[list[int]]) -> list[list[int]]:
-    num_relations = len(dg)
-    visited: list[bool] = [False for i in range(num_relations)]
-    result: list[list[int]] = []
-
-    def on_scc(scc: list[int]):
-        for r in scc:
-            visited[r] = True
-        result.append(scc)
-
-    def get_successors(r: int) -> list[int]:
-        return (rr for rr in dg[r] if not visited[rr])
+def _iterate_bits(mask: int) -> Iterable[int]:
+    while mask:
+        bit = mask & -mask
+        yield bit.bit_length() - 1
+        mask ^= bit
 
-    for r in range(num_relations):
-        if not visited[r]:
-            tarjan(r, get_successors, on_scc)
 
+def _get_dependent_components(dg: list[int]) -> list[list[int]]:
+    num_relations = len(dg)
+    # plain successor lists; the additional node num_relations is a virtual
+    # root connected to every relation, so that a single run of Tarjan's
+    # algorithm covers the entire graph
+    successors: list[Iterable[int]] = [list(_iterate_bits(mask)) for mask in dg]
+    successors.append(range(num_relations))
+    result: list[list[int]] = []
+    tarjan(num_relations, successors.__getitem__, result.append)
+    # nothing depends on the virtual root, hence it is closed last
+    assert result[-1] == [num_relations]
+    result.pop()
     return result
 
 
 def _is_stratified(
     num_relations: int, clauses: Iterable[NormalizedClause], components: list[list[int]]
 ):
-    component_idx = [None for i in range(num_relations)]
-    for i, c in enumerate(components):
-        for r in c:
+    component_idx: list[int | None] = [None] * num_relations
+    # forbidden[i]: bitmask of the relations in component i or any later
+    # component; negated atoms must refer to strictly earlier components
+    forbidden: list[int] = [0] * (len(components) + 1)
+    for i in range(len(components) - 1, -1, -1):
+        mask = forbidden[i + 1]
+        for r in components[i]:
             component_idx[r] = i
+            mask |= 1 << r
+        forbidden[i] = mask
     for clause in clauses:
+        neg_mask = 0
         for atom in clause.negative:
-            if (
-                component_idx[atom.relation_id]
-                >= component_idx[clause.head.relation_id]
-            ):
-                return False
+            neg_mask |= 1 << atom.relation_id
+        if neg_mask & forbidden[component_idx[clause.head.relation_id]]:
+            return False
     return True
 
 
@@ -157,30 +226,45 @@ def _get_query_engine_code(
     query_trees = list(
         (_generate_query_tree(clause, cost_function) for clause in clauses)
     )
-    evaluator_code = [
-        f"### num clauses: {len(clauses)}",
-        f"### num relations: {num_relations}",
-    ] + [
-        f"### clause {idx}: {clauses[idx].head} := {tree}"
-        for idx, tree in enumerate(query_trees)
-    ]
+    evaluator_code = []
+    if EMIT_COMMENTS:
+        evaluator_code.extend([
+            f"### num clauses: {len(clauses)}",
+            f"### num relations: {num_relations}",
+        ])
+        evaluator_code.extend((
+            f"### clause {idx}: {clauses[idx].head} := {tree}"
+            for idx, tree in enumerate(query_trees)
+        ))
+    fluent_ids = set(
+        (
+            fluent.function_id
+            for clause in clauses
+            for constraint in clause.constraints
+            for fluent in fluent_iterator(constraint.expr)
+        )
+    )
+    if len(fluent_ids) > 0:
+        evaluator_code.append(compile_fluent_lookups(fluent_ids))
+    clauses_by_head: dict[int, list[int]] = {}
+    for i, clause in enumerate(clauses):
+        clauses_by_head.setdefault(clause.head.relation_id, []).append(i)
     for group in dependent_clauses:
-        clause_idxs = [
-            i for i, clause in enumerate(clauses) if clause.head.relation_id in group
-        ]
+        clause_idxs = sorted((i for r in group for i in clauses_by_head.get(r, [])))
         if len(clause_idxs) == 0:
             continue
-        if len(group) > 1 or group[0] in dependency_graph[group[0]]:
+        if len(group) > 1 or (dependency_graph[group[0]] >> group[0]) & 1:
             relations = [clauses[idx].head.relation_id for idx in clause_idxs]
             relation_args = [
                 tuple((symb.id for symb in clauses[idx].head.arguments))
                 for idx in clause_idxs
             ]
             rules = [query_trees[idx] for idx in clause_idxs]
-            evaluator_code.extend((
-                f"## {clauses[idx].head} := {str(query_trees[idx])}"
-                for idx in clause_idxs
-            ))
+            if EMIT_COMMENTS:
+                evaluator_code.extend((
+                    f"## {clauses[idx].head} := {str(query_trees[idx])}"
+                    for idx in clause_idxs
+                ))
             evaluator_code.append(
                 compile_interdepending(relations, relation_args, rules, num_relations)
             )
@@ -188,9 +272,10 @@ def _get_query_engine_code(
             assert len(group) == 1
             for idx in clause_idxs:
                 clause = clauses[idx]
-                evaluator_code.append(
-                    f"## {clauses[idx].head} := {str(query_trees[idx])}"
-                )
+                if EMIT_COMMENTS:
+                    evaluator_code.append(
+                        f"## {clauses[idx].head} := {str(query_trees[idx])}"
+                    )
                 evaluator_code.append(
                     compile_without_dependencies(
                         clause.head.relation_id,
@@ -199,7 +284,15 @@ def _get_query_engine_code(
                         num_relations,
                     )
                 )
-    evaluator_code = "\n".join(evaluator_code)
+    # wrap everything into a function, so that the evaluator's registers are
+    # local variables
+    evaluator_code = "\n".join(
+        itertools.chain(
+            [f"def {EVALUATOR}({FLUENTS}, {RELATIONS}):"],
+            (f"  {line}" for line in "\n".join(evaluator_code).split("\n")),
+            [f"  return {RELATIONS}"],
+        )
+    )
     # print()
     # print()
     # print(evaluator_code)
@@ -208,6 +301,66 @@ def _get_query_engine_code(
     return evaluator_code, compile(evaluator_code, "<string>", "exec")
 
 
+def _load_query_engine(
+    code,
+) -> Callable[[FluentsDatabase | None, Database], Database]:
+    """
+    Executes the compiled query engine code, returning the evaluator function.
+    """
+    namespace = {}
+    exec(code, namespace)
+    return namespace[EVALUATOR]
+
+
+def _ground_atom_signature(atom: GroundAtomRef) -> AtomSignature:
+    return (atom.relation, tuple(atom.objects))
+
+
+class _ClausesKey:
+    """
+    Hashable wrapper around a list of normalized clauses. Two keys compare
+    equal iff the clauses are structurally identical, i.e., would result in
+    the same query engine code.
+    """
+
+    def __init__(self, clauses: list[NormalizedClause]):
+        self.clauses: list[NormalizedClause] = clauses
+        self.key: tuple = tuple((
+            (
+                _atom_signature(clause.head),
+                tuple((_atom_signature(atom) for atom in clause.positive)),
+                tuple((_atom_signature(atom) for atom in clause.negative)),
+                tuple((_ground_atom_signature(g) for g in clause.ground_positive)),
+                tuple((_ground_atom_signature(g) for g in clause.ground_negative)),
+                clause.vars_eq,
+                clause.vars_neq,
+                clause.obj_eq,
+                clause.obj_neq,
+                tuple((str(constraint) for constraint in clause.constraints)),
+            )
+            for clause in clauses
+        ))
+        self.hash: int = hash(self.key)
+
+    def __hash__(self) -> int:
+        return self.hash
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, _ClausesKey) and self.key == other.key
+
+
+@functools.lru_cache(maxsize=128)
+def _get_query_engine_code_cached(
+    num_relations: int, clauses_key: _ClausesKey, cost_function
+):
+    """
+    Memoized version of _get_query_engine_code. cost_function is part of the
+    cache key (compared by identity), so it must not be re-created for every
+    call.
+    """
+    return _get_query_engine_code(num_relations, clauses_key.clauses, cost_function)
+
+
 def _extract_eq_atom(
     source: Iterable[Atom],
     atoms: list[Atom],
@@ -215,22 +368,25 @@ def _extract_eq_atom(
     objs: list[tuple[int, int]],
     eq_relation: int,
 ):
+    # bind the append methods to locals (this is called for every clause)
+    add_variables = variables.append
+    add_objs = objs.append
+    add_atom = atoms.append
     for atom in source:
         if atom.relation_id == eq_relation:
-            assert len(atom.arguments) == 2
-            x = atom.arguments[0]
-            y = atom.arguments[1]
-            if x.is_variable():
-                if y.is_variable():
-                    variables.append((min(x.id, y.id), max(x.id, y.id)))
+            x, y = atom.arguments
+            if x.variable:
+                if y.variable:
+                    xi, yi = x.id, y.id
+                    add_variables((xi, yi) if xi <= yi else (yi, xi))
                 else:
-                    objs.append((x.id, y.id))
-            elif y.is_variable():
-                objs.append((y.id, x.id))
+                    add_objs((x.id, y.id))
+            elif y.variable:
+                add_objs((y.id, x.id))
             else:
                 assert False
         else:
-            atoms.append(atom)
+            add_atom(atom)
 
 
 def _separate_ground_atoms(
@@ -249,6 +405,21 @@ def _separate_ground_atoms(
     return non_ground_atoms, ground_atoms
 
 
+_OBJ_ATOM_CACHE: dict[tuple[int, int], Atom] = {}
+
+
+def _object_atom(object_relation: int, varid: int) -> Atom:
+    """
+    Returns the (shared) atom binding variable varid via the object relation.
+    """
+    key = (object_relation, varid)
+    atom = _OBJ_ATOM_CACHE.get(key, None)
+    if atom is None:
+        atom = Atom(object_relation, [Constant(varid, True)])
+        _OBJ_ATOM_CACHE[key] = atom
+    return atom
+
+
 def _normalize_clause(
     clause: Clause, eq_relation: int, object_relation: int
 ) -> NormalizedClause:
@@ -268,9 +439,9 @@ def _normalize_clause(
 
     variables = set()
     for atom in itertools.chain([clause.head], positive, negative):
-        variables = variables | set(atom.get_variables())
+        variables.update(atom.get_variables())
     for constr in clause.constraints:
-        variables = variables | set(constr.expr.get_variables())
+        variables.update(constr.expr.get_variables())
     variables = dict(
         (var, Constant(i, True)) for i, var in enumerate(sorted(variables))
     )
@@ -291,9 +462,14 @@ def _normalize_clause(
     objs_eq = [(variables[x].id, y) for (x, y) in objs_eq if x in variables]
     objs_neq = [(variables[x].id, y) for (x, y) in objs_neq]
 
+    # bind every variable not appearing in any positive atom via the object
+    # relation
+    bound = 0
+    for atom in positive:
+        bound |= atom.get_variable_mask()
     for varid in range(len(variables)):
-        if not any((varid in atom.get_variables() for atom in positive)):
-            positive.append(Atom(object_relation, [Constant(varid, True)]))
+        if not (bound >> varid) & 1:
+            positive.append(_object_atom(object_relation, varid))
 
     return NormalizedClause(
         head,
@@ -316,34 +492,63 @@ class DatalogEngine:
         program: DatalogProgram,
         num_objects: int,
         cost_function=_cost_function,
+        cache_code: bool = True,
     ):
+        """
+        cache_code enables sharing the generated query engine code between
+        engines of structurally identical programs. Disable it if
+        cost_function is not a stable object (e.g., a closure created on the
+        fly), as it is part of the cache key.
+        """
         self.num_relations = program.num_relations() + 1
         self.object_relation = program.num_relations()
-        self.code, self.bin = _get_query_engine_code(
-            self.num_relations,
-            list(
-                _normalize_clause(
-                    clause, program.equality_relation, self.object_relation
-                )
-                for clause in program.clauses
-            ),
-            cost_function,
+        clauses = list(
+            _normalize_clause(clause, program.equality_relation, self.object_relation)
+            for clause in program.clauses
         )
+        if cache_code:
+            self.code, self.bin = _get_query_engine_code_cached(
+                self.num_relations, _ClausesKey(clauses), cost_function
+            )
+        else:
+            self.code, self.bin = _get_query_engine_code(
+                self.num_relations, clauses, cost_function
+            )
+        self.evaluate = _load_query_engine(self.bin)
         self.static_atoms = list(program.trivial_clauses)
-        self.static_atoms.extend([
-            Atom(self.object_relation, [Constant(obj, False)])
-            for obj in range(num_objects)
-        ])
-
-    def __call__(
-        self, facts: Database, fluents: FluentsDatabase | None = None
-    ) -> Database:
-        env = {FLUENTS: fluents, RELATIONS: [set(r) for r in facts]}
-        env[RELATIONS].append(set())
+        static_by_rel: dict[int, list[tuple[int]]] = {}
         for atom in self.static_atoms:
-            env[RELATIONS][atom.relation_id].add(
+            static_by_rel.setdefault(atom.relation_id, []).append(
                 tuple((arg.id for arg in atom.arguments))
             )
-        exec(self.bin, env)
-        del env[RELATIONS][self.object_relation]
-        return env[RELATIONS]
+        # (relation, tuples) pairs for all relations with static tuples
+        self._static_tuples: tuple[tuple[int, tuple[tuple[int]]]] = tuple(
+            (r, tuple(tuples)) for r, tuples in sorted(static_by_rel.items())
+        )
+        # the object relation is never modified by the evaluator, hence can be
+        # shared between all calls
+        self.objects: frozenset[tuple[int]] = frozenset(
+            ((obj,) for obj in range(num_objects))
+        )
+
+    def __call__(
+        self,
+        facts: Database,
+        fluents: FluentsDatabase | None = None,
+        mutate_inplace: bool = False,
+    ) -> Database:
+        """
+        Computes the model of the program for the given facts. If
+        mutate_inplace is set, the derived tuples are added directly to the
+        sets in facts rather than to copies of them.
+        """
+        if mutate_inplace:
+            relations = list(facts)
+        else:
+            relations = [r.copy() for r in facts]
+        for r, tuples in self._static_tuples:
+            relations[r].update(tuples)
+        relations.append(self.objects)
+        self.evaluate(fluents, relations)
+        del relations[self.object_relation]
+        return relations
@@ -25,6 +25,12 @@ FLUENTS = "fluents"
 
 RELATIONS = "relations"
 
+EVALUATOR = "evaluate"
+
+BUCKET = "_bucket"
+
+TUPLE = "_tuple"
+
 VariableSubscripts = Callable[[int], str]
 
 
@@ -125,10 +131,12 @@ class InsertDict(InstructionNode):
         self.val: str = val
 
     def to_string(self, depth: int = 0) -> str:
-        a = self._indent(depth, f"if {self.key} not in {self.dest}:")
-        b = self._indent(depth + 1, f"{self.dest}[{self.key}] = set()")
-        c = self._indent(depth, f"{self.dest}[{self.key}].add({self.val})")
-        return "\n".join((a, b, c))
+        # single lookup of the key in the common case that the entry exists
+        a = self._indent(depth, f"{BUCKET} = {self.dest}.get({self.key})")
+        b = self._indent(depth, f"if {BUCKET} is None:")
+        c = self._indent(depth + 1, f"{BUCKET} = {self.dest}[{self.key}] = set()")
+        d = self._indent(depth, f"{BUCKET}.add({self.val})")
+        return "\n".join((a, b, c, d))
 
 
 def InsertDictIf(dest: str, key: str, val: str, condition: str | None):
@@ -211,11 +219,7 @@ class DictCompren(InstructionNode):
         if self.condition:
             instr.append(self._indent(depth + 1, f"if not ({self.condition}):"))
             instr.append(self._indent(depth + 2, "continue"))
-        instr.append(self._indent(depth + 1, f"if {self.key} not in {self.dest}:"))
-        instr.append(self._indent(depth + 2, f"{self.dest}[{self.key}] = set()"))
-        instr.append(
-            self._indent(depth + 1, f"{self.dest}[{self.key}].add({self.val})")
-        )
+        instr.append(InsertDict(self.dest, self.key, self.val).to_string(depth + 1))
         return "\n".join(instr)
 
 
@@ -234,8 +238,27 @@ def get_fluent_arguments(fluent: datalog.Fluent, get_value: VariableSubscripts)
     return f"({', '.join((get_value(arg) for arg in args))},)"
 
 
+def get_fluent_lookup(fluent_id: int) -> str:
+    return f"_fluent{fluent_id}"
+
+
 def get_fluent(fluent_id: int, fluent_args: str) -> str:
-    return f"{FLUENTS}[{fluent_id}].get({fluent_args}, None)"
+    return f"{get_fluent_lookup(fluent_id)}({fluent_args})"
+
+
+def compile_fluent_lookups(fluent_ids: Iterable[int]) -> str:
+    """
+    Binds the lookup function of every referenced fluent table to a local
+    variable (see get_fluent). The fluent tables are only accessed if given, so
+    that they remain optional as long as no constraint needs to be evaluated.
+    """
+    return InstructionSequence(
+        Assign(
+            get_fluent_lookup(fluent_id),
+            f"None if {FLUENTS} is None else {FLUENTS}[{fluent_id}].get",
+        )
+        for fluent_id in sorted(fluent_ids)
+    ).to_string()
 
 
 AbstractDatabase = Callable[[int], str]
@@ -532,11 +555,25 @@ class BuildData:
     def __init__(self, dynamic_relations: Iterable[int]):
         self.dynamic_relations: set[int] = set(dynamic_relations)
         self.eval_cache = {}
+        # guard conditions under which cached results have been computed
+        self.cache_guards: dict["EvalBuilder", str] = {}
+
+    def guard_cache(self, keys: Iterable["EvalBuilder"], condition: str | None) -> None:
+        for key in keys:
+            self.cache_guards[key] = _and(condition, self.cache_guards.get(key))
 
     def clean_cache(self) -> list[InstructionNode]:
         instrs = []
-        for cached in self.eval_cache.values():
-            instrs.extend(cached.make_cleanup())
+        for key, cached in self.eval_cache.items():
+            cleanup = cached.make_cleanup()
+            guard = self.cache_guards.get(key)
+            if cleanup and guard:
+                # result only exists if the guard was satisfied
+                instrs.append(
+                    ConditionalInstruction(InstructionSequence(cleanup), guard)
+                )
+            else:
+                instrs.extend(cleanup)
         return instrs
 
 
@@ -926,6 +963,7 @@ class ConditionalBuilder(EvalBuilder):
         subscripts: Subscriptor,
     ):
         idx: int = len(program.instructions)
+        cached = set(build_data.eval_cache)
         self.child.make_iteration(
             build_data,
             program,
@@ -933,12 +971,23 @@ class ConditionalBuilder(EvalBuilder):
             handle,
             subscripts,
         )
+        added = [key for key in build_data.eval_cache if key not in cached]
+        condition = self.condition.generate(database)
+        if self.condition.has_dynamic_dependency(build_data.dynamic_relations):
+            # the condition might only become true later in the fixpoint
+            # computation, where results cached now would not be available;
+            # discard them at the end of the guarded block instead
+            for key in added:
+                program.instructions.extend(
+                    build_data.eval_cache.pop(key).make_cleanup()
+                )
+        else:
+            # results cached by the child only exist if the condition holds
+            build_data.guard_cache(added, condition)
         instructions = program.instructions[idx:]
         del program.instructions[idx:]
         program.instructions.append(
-            ConditionalInstruction(
-                InstructionSequence(instructions), self.condition.generate(database)
-            )
+            ConditionalInstruction(InstructionSequence(instructions), condition)
         )
 
     def _dump(self) -> str:
@@ -1824,13 +1873,21 @@ def compile_interdepending(
     def insert_into_delta_prime_handle(relation: int, relation_args: tuple[int]):
         def handle(subscripts: Subscriptor):
             tupl: str = subscripts.get_tuple(relation_args)
+            instructions = []
+            # construct the tuple only once if not readily available
+            if not tupl.isidentifier():
+                instructions.append(Assign(TUPLE, tupl))
+                tupl = TUPLE
             # insert into delta_prime if tupl not contained in delta and not in
             # relation
-            return ConditionalInstruction(
-                Insert(get_relation_delta_primed(relation), tupl),
-                f"{tupl} not in {get_relation_delta(relation)}"
-                f" and {tupl} not in {lookup_relation(relation)}",
+            instructions.append(
+                ConditionalInstruction(
+                    Insert(get_relation_delta_primed(relation), tupl),
+                    f"{tupl} not in {get_relation_delta(relation)}"
+                    f" and {tupl} not in {lookup_relation(relation)}",
+                )
             )
+            return InstructionSequence(instructions)
 
         return handle
 
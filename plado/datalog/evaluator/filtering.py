@@ -83,7 +83,7 @@ def insert_constraint_predicate(constraint: NumericConstraint, root: QNode) -> Q
     )
 
 
-def insert_projections(node: QNode, args: set[int]) -> QNode:
+def insert_projections(node: QNode, args: set[int] | frozenset[int]) -> QNode:
     if isinstance(node, InnerNode):
         common_args = (
             set(
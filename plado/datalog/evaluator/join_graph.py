@@ -29,6 +29,16 @@ class JoinGraph:
         self.arcs: list[list[Node]] = None
         self.var_to_nodes: list[list[int]] = None
 
+    def copy(self) -> "JoinGraph":
+        """
+        Copy of the graph's adjacency structure (sharing the immutable nodes).
+        """
+        jg = JoinGraph()
+        jg.nodes = list(self.nodes)
+        jg.arcs = [list(arcs) for arcs in self.arcs]
+        jg.var_to_nodes = [list(nodes) for nodes in self.var_to_nodes]
+        return jg
+
 
 def create_node(atom: Atom, idx: int, negative: bool) -> Node:
     return Node(
@@ -11,6 +11,7 @@ from plado.datalog.evaluator.query_tree import (
     QNode,
     is_contained,
 )
+from plado.datalog.program import Atom
 from plado.utils.graph import tarjan
 from plado.utils.union_find import UnionFind
 
@@ -18,6 +19,13 @@ Nodes = dict[int, QNode]
 
 
 class GreedyOptimizer:
+    """
+    Builds the join tree bottom-up, repeatedly joining the cheapest pair of
+    sub-trees. Only pairs connected in the join graph (i.e., sharing a
+    variable) are considered. Cross products are taken only if no such pair is
+    left, independent of what the cost estimator says.
+    """
+
     def __init__(
         self,
         cost_estimator: Callable[
@@ -272,3 +280,165 @@ class GreedyOptimizer:
         for i in range(1, len(nodes)):
             node = ProductNode(node, nodes[i], node.cost * nodes[i].cost)
         return node
+
+
+def plan_single_atom(
+    positive: Atom,
+    negative: Iterable[Atom],
+    cost_estimator: Callable[[set[int], ArgRefMap, set[int], ArgRefMap], int],
+) -> QNode:
+    """
+    Query tree for a clause body with a single positive atom, which is
+    trivially optimal: the atom's relation minus all negative atoms. (Every
+    variable is positively bounded, so all negative atoms can be subtracted
+    right away.) No join graph is needed.
+    """
+
+    def make_leaf(atom: Atom) -> LeafNode:
+        leaf = LeafNode(atom.relation_id, (arg.id for arg in atom.arguments), [], 0)
+        leaf.cost = cost_estimator(
+            leaf.get_relations(), leaf.get_argument_map(), set(), {}
+        )
+        return leaf
+
+    qnode = make_leaf(positive)
+    for atom in negative:
+        leaf = make_leaf(atom)
+        qnode = DifferenceNode(qnode, leaf, max(qnode.cost, leaf.cost))
+    return qnode
+
+
+class DpCcpOptimizer(GreedyOptimizer):
+    """
+    Computes the cheapest bushy join tree via dynamic programming over the
+    connected subsets of the (positive) join-graph nodes, combining only
+    connected sub-plans (csg-cmp pairs). The cost of a plan is the sum of the
+    costs of its joins. The number of enumerated pairs is exponential in the
+    number of nodes, hence this is meant for small join graphs only.
+    """
+
+    def _get_neighbor_masks(self, node_ids: list[int]) -> list[int]:
+        index = {node_id: i for i, node_id in enumerate(node_ids)}
+        neighbors = [0] * len(node_ids)
+        for i, node_id in enumerate(node_ids):
+            for succ in self.jg.arcs[node_id]:
+                j = index.get(succ.node_id, None)
+                if j is not None:
+                    neighbors[i] |= 1 << j
+        return neighbors
+
+    def _enumerate_plans(
+        self, nodes: list[QNode], neighbors: list[int]
+    ) -> dict[int, tuple[int, int, QNode]]:
+        """
+        Returns for every connected subset of nodes (bitmask) the total cost of
+        its cheapest plan, the subset of the plan's left child (which need not
+        contain the subset's lowest node), and the plan's root. Subtractions are
+        not yet applied.
+        """
+        plans: dict[int, tuple[int, int, QNode]] = {}
+        subset_neighbors: list[int] = [0] * (1 << len(nodes))
+        for mask in range(1, 1 << len(nodes)):
+            low = mask & -mask
+            rest = mask ^ low
+            i = low.bit_length() - 1
+            subset_neighbors[mask] = subset_neighbors[rest] | neighbors[i]
+            if rest == 0:
+                plans[mask] = (0, 0, nodes[i])
+                continue
+            best = None
+            # enumerate all splits into two non-empty subsets, fixing the
+            # lowest node in the left subset to avoid symmetric duplicates
+            sub = rest
+            while True:
+                left = low | sub
+                right = mask ^ left
+                if (
+                    right != 0
+                    and left in plans
+                    and right in plans
+                    and subset_neighbors[left] & right
+                ):
+                    left_cost, _, left_node = plans[left]
+                    right_cost, _, right_node = plans[right]
+                    # the cost estimate need not be symmetric; consider both
+                    # orientations of the split
+                    for l_mask, l_node, r_node in (
+                        (left, left_node, right_node),
+                        (right, right_node, left_node),
+                    ):
+                        cost = self.cost_estimator(
+                            l_node.get_relations(),
+                            l_node.get_argument_map(),
+                            r_node.get_relations(),
+                            r_node.get_argument_map(),
+                        )
+                        total = left_cost + right_cost + cost
+                        if best is None or total < best[0]:
+                            best = (total, l_mask, cost, l_node, r_node)
+                if sub == 0:
+                    break
+                sub = (sub - 1) & rest
+            if best is not None:
+                total, left, cost, left_node, right_node = best
+                plans[mask] = (total, left, JoinNode(left_node, right_node, cost))
+        return plans
+
+    def _build_plan(
+        self,
+        mask: int,
+        plans: dict[int, tuple[int, int, QNode]],
+        subtraction: dict[tuple[int], list[LeafNode]],
+    ) -> QNode:
+        """
+        Reconstruct the plan stored for mask, applying subtractions as early as
+        possible.
+        """
+        _, left, root = plans[mask]
+        if left == 0:
+            return root
+        return self._join_nodes(
+            root.cost,
+            self._build_plan(left, plans, subtraction),
+            self._build_plan(mask ^ left, plans, subtraction),
+            subtraction,
+            JoinNode,
+        )
+
+    def _compute_join_ordering(self, node_ids: list[int]) -> QNode:
+        assert len(node_ids) > 0
+        nodes, subtraction = self._create_jt_nodes(node_ids)
+        if len(nodes) == 0:
+            assert len(subtraction) == 1 and tuple() in subtraction
+            return self._apply_subtractions(EmptyTupleNode(), subtraction)
+        positive_ids = list(nodes.keys())
+        positive_nodes = list(nodes.values())
+        neighbors = self._get_neighbor_masks(positive_ids)
+        plans = self._enumerate_plans(positive_nodes, neighbors)
+        # the positive nodes might not be connected (only via negative nodes);
+        # take the best plan for every connected part, and combine them via
+        # products
+        jg_to_jt = UnionFind(len(self.jg.nodes))
+        parts: Nodes = {}
+        remaining = (1 << len(positive_nodes)) - 1
+        while remaining:
+            part = remaining & -remaining
+            frontier = part
+            while frontier:
+                bit = frontier & -frontier
+                frontier ^= bit
+                new = neighbors[bit.bit_length() - 1] & remaining & ~part
+                part |= new
+                frontier |= new
+            remaining ^= part
+            members = [
+                node_id for i, node_id in enumerate(positive_ids) if (part >> i) & 1
+            ]
+            part_id = members[0]
+            for node_id in members[1:]:
+                part_id = jg_to_jt.merge(part_id, node_id)
+            parts[part_id] = self._build_plan(part, plans, subtraction)
+        while len(parts) > 1:
+            self._select_and_join(parts, subtraction, jg_to_jt)
+        assert len(parts) == 1
+        return tuple(parts.values())[0]
@@ -50,6 +50,16 @@ class Atom:
     def get_variables(self) -> list[int]:
         return list((arg.id for arg in self.arguments if arg.is_variable()))
 
+    def get_variable_mask(self) -> int:
+        """
+        Bitmask of the variable ids appearing in the arguments.
+        """
+        mask = 0
+        for arg in self.arguments:
+            if arg.variable:
+                mask |= 1 << arg.id
+        return mask
+
     def standardize_arguments(
         self,
         next_var_id: IntRef,
@@ -3,7 +3,16 @@ import itertools
 import pytest
 
 from plado.datalog import evaluator
-from plado.datalog.program import Atom, Clause, Constant
+from plado.datalog.evaluator.filtering import insert_projections
+from plado.datalog.evaluator.query_tree import (
+    GroundAtomRef,
+    GroundAtomsNode,
+    JoinNode,
+    LeafNode,
+)
+from plado.datalog.numeric import Constant as NumericConstant
+from plado.datalog.numeric import Fluent, NumericConstraint, Subtraction
+from plado.datalog.program import Atom, Clause, Constant, DatalogProgram
 
 
 def Var(x: int) -> Constant:
@@ -96,10 +105,10 @@ def test_dependency_graph_acyclic(AcycDepClauses):
         5, [evaluator._normalize_clause(c, 0, 4) for c in AcycDepClauses]
     )
     assert len(dg) == 5
-    assert set(dg[0]) == set()
-    assert set(dg[1]) == set([2, 3])
-    assert set(dg[2]) == set([3])
-    assert set(dg[3]) == set([3])
+    assert dg[0] == 0
+    assert dg[1] == 0b1100
+    assert dg[2] == 0b1000
+    assert dg[3] == 0b1000
 
 
 def test_dependent_components_acyclic(AcycDepClauses):
@@ -140,10 +149,10 @@ def test_dependency_graph_cyclic(CycDepClauses):
         5, [evaluator._normalize_clause(c, 0, 4) for c in CycDepClauses]
     )
     assert len(dg) == 5
-    assert set(dg[0]) == set()
-    assert set(dg[1]) == set([2, 3])
-    assert set(dg[2]) == set([3])
-    assert set(dg[3]) == set([1, 4])
+    assert dg[0] == 0
+    assert dg[1] == 0b1100
+    assert dg[2] == 0b1000
+    assert dg[3] == 0b10010
 
 
 def test_dependent_components_cyclic(CycDepClauses):
@@ -206,7 +215,8 @@ def test_qt_compilation_product(TakeProductRules):
         evaluator.RELATIONS: [set(), set(), a, b],
         evaluator.FLUENTS: [],
     }
-    exec(compiled, env)
+    evaluate = evaluator._load_query_engine(compiled)
+    evaluate(env[evaluator.FLUENTS], env[evaluator.RELATIONS])
     result = env[evaluator.RELATIONS][1]
     assert result == set(itertools.product(range(0, 10, 2), range(1, 10, 2)))
 
@@ -251,7 +261,8 @@ def test_qt_compilation_join(JoinRules):
             set((i + 1, i - 1) for i in range(1, 10, 1)),
         ],
     }
-    exec(compiled, env)
+    evaluate = evaluator._load_query_engine(compiled)
+    evaluate(env[evaluator.FLUENTS], env[evaluator.RELATIONS])
     result = env[evaluator.RELATIONS][1]
     assert result == set(((i, i - 1) for i in range(10)))
 
@@ -283,7 +294,8 @@ def test_qt_compilation_join_with_diff(JoinRulesWithDiff):
             set((i,) for i in range(0, 21, 2)),
         ],
     }
-    exec(compiled, env)
+    evaluate = evaluator._load_query_engine(compiled)
+    evaluate(env[evaluator.FLUENTS], env[evaluator.RELATIONS])
     result = env[evaluator.RELATIONS][1]
     assert result == set(((i, i - 1) for i in range(0, 20, 2)))
 
@@ -349,7 +361,8 @@ def test_qt_compilation_joint_with_filters_empty(JoinWithFilter):
             set(((i,) for i in range(1, 99, 2))),
         ],
     }
-    exec(compiled, env)
+    evaluate = evaluator._load_query_engine(compiled)
+    evaluate(env[evaluator.FLUENTS], env[evaluator.RELATIONS])
     result = env[evaluator.RELATIONS][1]
     assert result == set()
 
@@ -366,7 +379,8 @@ def test_qt_compilation_joint_with_filters(JoinWithFilter):
             set(((i,) for i in range(4, 99, 1))),
         ],
     }
-    exec(compiled, env)
+    evaluate = evaluator._load_query_engine(compiled)
+    evaluate(env[evaluator.FLUENTS], env[evaluator.RELATIONS])
     result = env[evaluator.RELATIONS][1]
     assert result == set(((2, i) for i in range(0, 99, 2) if i != 2))
 
@@ -398,6 +412,223 @@ def test_evaluation_closure(TransitiveClosure):
             set(((i,) for i in range(100)))
         ],
     }
-    exec(compiled, env)
+    evaluate = evaluator._load_query_engine(compiled)
+    evaluate(env[evaluator.FLUENTS], env[evaluator.RELATIONS])
     result = env[evaluator.RELATIONS][1]
     assert result == set(((i, j) for i in range(100) for j in range(i, 100)))
+
+
+def _make_closure_program() -> DatalogProgram:
+    program = DatalogProgram()
+    program.equality_relation = program.add_relation(2)
+    edge = program.add_relation(2)
+    path = program.add_relation(2)
+    program.add_clause(
+        Clause(Atom(path, [Var(0), Var(1)]), [Atom(edge, [Var(0), Var(1)])], [], [])
+    )
+    program.add_clause(
+        Clause(
+            Atom(path, [Var(0), Var(2)]),
+            [Atom(edge, [Var(1), Var(2)]), Atom(path, [Var(0), Var(1)])],
+            [],
+            [],
+        )
+    )
+    return program
+
+
+def test_engine_code_cache():
+    engine0 = evaluator.DatalogEngine(_make_closure_program(), 5)
+    engine1 = evaluator.DatalogEngine(_make_closure_program(), 10)
+    assert engine0.bin is engine1.bin
+    engine2 = evaluator.DatalogEngine(_make_closure_program(), 5, cache_code=False)
+    assert engine2.bin is not engine0.bin
+    assert engine2.code == engine0.code
+    facts = [set(), set(((i, i + 1) for i in range(4))), set()]
+    assert engine1(facts)[2] == set(((i, j) for i in range(5) for j in range(i + 1, 5)))
+
+
+def test_qt_generation_dp(JoinRulesWithDiff, TakeProductRules):
+    clause = JoinRulesWithDiff[0]
+    jg = evaluator.construct_join_graph(3, clause.positive, clause.negative)
+    planner = evaluator.DpCcpOptimizer(evaluator._cost_function)
+    jt = planner(jg)
+    assert jt.get_relations() == set([2, 3, 4])
+    assert set(jt.get_argument_map().keys()) == set([0, 1, 2])
+
+    clause = TakeProductRules[0]
+    jg = evaluator.construct_join_graph(2, clause.positive, clause.negative)
+    jt = planner(jg)
+    assert jt.get_relations() == set([2, 3])
+    assert set(jt.get_argument_map().keys()) == set([0, 1])
+
+
+def test_qt_generation_dp_asymmetric_cost(JoinRulesWithDiff):
+    def cost_function(left_rels, left_args, right_rels, right_args) -> int:
+        return 0 if 3 in left_rels else 1
+
+    clause = JoinRulesWithDiff[0]
+    jg = evaluator.construct_join_graph(3, clause.positive, clause.negative)
+    jt = evaluator.DpCcpOptimizer(cost_function)(jg)
+    assert jt.cost == 0
+
+
+@pytest.fixture
+def ProductWithDiff() -> list[evaluator.NormalizedClause]:
+    return list((
+        evaluator._normalize_clause(clause, 0, 5)
+        for clause in [
+            Clause(
+                Atom(1, [Var(0), Var(1)]),
+                [Atom(2, [Var(0)]), Atom(3, [Var(1)]), Atom(2, [Var(2)])],
+                [Atom(4, [Var(0)])],
+                [],
+            )
+        ]
+    ))
+
+
+def test_qt_compilation_product_with_diff(ProductWithDiff):
+    _, compiled = evaluator._get_query_engine_code(6, ProductWithDiff)
+    env = {
+        evaluator.FLUENTS: [],
+        evaluator.RELATIONS: [
+            set(),
+            set(),
+            set(((i,) for i in range(5))),
+            set(((i,) for i in range(3, 8))),
+            set(((i,) for i in range(0, 10, 2))),
+        ],
+    }
+    evaluate = evaluator._load_query_engine(compiled)
+    evaluate(env[evaluator.FLUENTS], env[evaluator.RELATIONS])
+    result = env[evaluator.RELATIONS][1]
+    assert result == set(((i, j) for i in range(1, 5, 2) for j in range(3, 8)))
+
+
+def _compile_guarded_closure(guard: GroundAtomRef) -> str:
+    # P2(?x0, ?x1) :- P1(?x0, ?x1)
+    # P4(?x1) :- P2(?x0, ?x1)
+    # P2(?x0, ?x2) :- guard, P3(?x1), P1(?x1, ?x2), P2(?x0, ?x1)
+    # with the static join of P3 and P1 on the left, so that it is cached
+    # within the guard
+    base = insert_projections(LeafNode(1, (0, 1), [], 0), set([0, 1]))
+    reached = insert_projections(LeafNode(2, (0, 1), [], 0), set([1]))
+    static = JoinNode(LeafNode(3, (1,), [], 0), LeafNode(1, (1, 2), [], 0), 0)
+    step = JoinNode(static, LeafNode(2, (0, 1), [], 0), 0)
+    step = GroundAtomsNode(insert_projections(step, set([0, 2])), [guard], False)
+    return evaluator.compile_interdepending(
+        [2, 4, 2], [(0, 1), (1,), (0, 2)], [base, reached, step], 5
+    )
+
+
+def test_compilation_static_guard_cache_cleanup():
+    code = _compile_guarded_closure(GroundAtomRef(3, (1,)))
+    # the join is cached across the fixpoint iterations, but only exists if
+    # the guard holds
+    head, cleanup = code.rsplit("\nif (1,) in relations[3]:\n  del ", 1)
+    assert head.count(f"{cleanup} = set()") == 1
+    assert cleanup in head.split("while")[1]
+    for guarded in [set([(0,)]), set([(0,), (1,)])]:
+        relations = [set(), set([(0, 1), (1, 2)]), set(), guarded, set()]
+        exec(code, {evaluator.RELATIONS: relations})
+        if (1,) in guarded:
+            assert relations[2] == set([(0, 1), (1, 2), (0, 2)])
+        else:
+            assert relations[2] == set([(0, 1), (1, 2)])
+
+
+def test_compilation_dynamic_guard_no_cache():
+    code = _compile_guarded_closure(GroundAtomRef(4, (2,)))
+    # the guard only becomes true within the fixpoint computation, hence the
+    # join must not be cached
+    assert code.endswith("del _delta_prime4")
+    relations = [set(), set([(0, 1), (1, 2)]), set(), set([(0,), (1,)]), set()]
+    exec(code, {evaluator.RELATIONS: relations})
+    assert relations[2] == set([(0, 1), (1, 2), (0, 2)])
+
+
+@pytest.fixture
+def ChainRules() -> list[evaluator.NormalizedClause]:
+    return list((
+        evaluator._normalize_clause(clause, 0, 4)
+        for clause in [
+            Clause(
+                Atom(1, [Var(0), Var(3)]),
+                [
+                    Atom(2, [Var(0), Var(1)]),
+                    Atom(3, [Var(2), Var(3)]),
+                    Atom(2, [Var(1), Var(2)]),
+                ],
+                [],
+                [],
+            )
+        ]
+    ))
+
+
+def test_qt_generation_no_products_if_connected(ChainRules):
+    # cost function favoring products over joins
+    def prefer_products(relations, args, join_relation, join_args):
+        return len(args.keys() & join_args.keys())
+
+    clause = ChainRules[0]
+    for planner in [
+        evaluator.GreedyOptimizer(prefer_products),
+        evaluator.DpCcpOptimizer(prefer_products),
+    ]:
+        jg = evaluator.construct_join_graph(4, clause.positive, clause.negative)
+        jt = planner(jg)
+        assert jt.get_relations() == set([2, 3])
+        assert set(jt.get_argument_map().keys()) == set([0, 1, 2, 3])
+        assert " X " not in str(jt)
+
+
+def test_join_graph_cache(JoinRules):
+    clause = JoinRules[0]
+    key = (
+        clause.num_variables,
+        tuple((evaluator._atom_signature(atom) for atom in clause.positive)),
+        tuple((evaluator._atom_signature(atom) for atom in clause.negative)),
+    )
+    jg = evaluator._build_join_graph(key)
+    assert evaluator._build_join_graph(key) is jg
+    jg_copy = jg.copy()
+    jg_copy.arcs[0].clear()
+    assert len(jg.arcs[0]) == 1
+    assert [n.args for n in jg.nodes] == [(0, 2), (2, 1)]
+
+
+def test_evaluation_numeric_constraint():
+    # P1(?x0) :- P2(?x0), F0(?x0) - 2 >= 0
+    constraint = NumericConstraint(
+        Subtraction(Fluent(0, [0], [(0, 0)]), NumericConstant(2)),
+        NumericConstraint.GREATER_EQUAL,
+    )
+    clauses = [
+        evaluator._normalize_clause(
+            Clause(Atom(1, [Var(0)]), [Atom(2, [Var(0)])], [], [constraint]), 0, 3
+        )
+    ]
+    code, compiled = evaluator._get_query_engine_code(4, clauses)
+    # the fluent table is looked up once, outside of the loops
+    assert code.count("_fluent0 = None if fluents is None else fluents[0].get") == 1
+    assert "fluents[" not in code.split("for ", 1)[1]
+    evaluate = evaluator._load_query_engine(compiled)
+    relations = [set(), set(), set(((i,) for i in range(10)))]
+    fluents = [{(i,): float(i) for i in range(0, 10, 2)}]
+    evaluate(fluents, relations)
+    assert relations[1] == set(((i,) for i in range(2, 10, 2)))
+    # fluents are not needed if the constraint is never evaluated
+    assert evaluate(None, [set(), set(), set()]) == [set(), set(), set()]
+
+
+def test_engine_mutate_inplace():
+    engine = evaluator.DatalogEngine(_make_closure_program(), 3)
+    facts = [set(), set([(0, 1), (1, 2)]), set()]
+    result = engine(facts)
+    assert facts[2] == set()
+    assert result[2] == set([(0, 1), (1, 2), (0, 2)])
+    result = engine(facts, mutate_inplace=True)
+    assert result[2] is facts[2]
+    assert facts[2] == set([(0, 1), (1, 2), (0, 2)])